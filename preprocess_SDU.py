@@ -2,6 +2,8 @@
 # Copyright (c) Microsoft Corporation.
 
 import os
+import json
+import pickle
 import numpy as np
 import pandas as pd
 
@@ -9,12 +11,22 @@ from tqdm import tqdm
 from numba import njit
 from typing import List
 from pathlib import Path
-from scipy.signal import medfilt
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from batteryml import BatteryData, CycleData
 from batteryml.builders import PREPROCESSORS
 from batteryml.preprocess.base import BasePreprocessor
 
+# Only the columns used by the preprocessor are parsed
+CSV_DTYPES = {
+    'Battery_ID': 'int32',
+    'Test_Time(s)': 'float64',
+    'Current(A)': 'float32',
+    'Voltage(V)': 'float32',
+    'Cycle_Index': 'int32',
+}
+
 
 @PREPROCESSORS.register()
 class SDUPreprocessor(BasePreprocessor):
@@ -32,24 +44,76 @@ class SDUPreprocessor(BasePreprocessor):
         process_batteries_num = 0
         skip_batteries_num = 0
         
-        # Process each CSV file
-        for csv_file in tqdm(raw_files, desc="Processing CSV files"):
-            if not self.silent:
-                print(f'Processing {csv_file.name}')
-            
-            # Load the CSV file
-            try:
-                df = pd.read_csv(csv_file)
-            except Exception as e:
-                print(f"Error reading {csv_file}: {e}")
-                continue
-            
-            # Group by Battery_ID to handle multiple batteries in one file
-            for battery_id, battery_df in df.groupby('Battery_ID'):
+        # CSV files are independent of each other, so process them in parallel,
+        # unless a single worker is requested or there is only one file
+        num_workers = min(kwargs.get('num_workers') or os.cpu_count() or 1, len(raw_files))
+        if num_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            results = executor.map(self._process_one_csv, raw_files)
+        else:
+            executor = nullcontext()
+            results = map(self._process_one_csv, raw_files)
+        
+        with executor:
+            for processed, skipped in tqdm(results, total=len(raw_files), desc="Processing CSV files"):
+                process_batteries_num += processed
+                skip_batteries_num += skipped
+        
+        return process_batteries_num, skip_batteries_num
+
+    def _process_one_csv(self, csv_file):
+        """
+        Process all batteries in a single CSV file, returning the number of
+        processed and skipped batteries
+        """
+        process_batteries_num = 0
+        skip_batteries_num = 0
+        
+        if not self.silent:
+            print(f'Processing {csv_file.name}')
+        
+        # Skip the whole file if the cached battery index shows that all of
+        # its batteries have been processed or have no clean cycles
+        battery_index = self.load_battery_index(csv_file)
+        no_clean_ids = set(battery_index['no_clean_ids']) if battery_index is not None else set()
+        if battery_index is not None and self.check_processed_batteries(battery_index['ids'], no_clean_ids):
+            return process_batteries_num, len(battery_index['ids'])
+        
+        # Load the CSV file
+        try:
+            df = pd.read_csv(
+                csv_file,
+                engine='pyarrow',
+                usecols=list(CSV_DTYPES),
+                dtype=CSV_DTYPES)
+        except Exception as e:
+            print(f"Error reading {csv_file}: {e}")
+            return process_batteries_num, skip_batteries_num
+        
+        # Sort by Battery_ID and Test_Time(s) once, so that every battery is a
+        # contiguous block of rows sorted by time - equivalent to CALCE's
+        # date+time sorting, since we don't have dates
+        df = df.sort_values(['Battery_ID', 'Test_Time(s)'], kind='stable')
+        ids = df['Battery_ID'].to_numpy()
+        t_all = df['Test_Time(s)'].to_numpy()
+        I_all = df['Current(A)'].to_numpy()
+        V_all = df['Voltage(V)'].to_numpy()
+        ci_all = df['Cycle_Index'].to_numpy(np.int32, copy=False)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1, [len(ids)]))
+        
+        # Dump the pickles from a background thread while the next battery
+        # is being processed
+        dumps = []
+        with ThreadPoolExecutor(max_workers=1) as io_pool:
+            # Handle multiple batteries in one file
+            for start, end in zip(starts[:-1], starts[1:]):
+                battery_id = int(ids[start])
                 cell_name = f"Battery_{battery_id}"
                 
-                # Check whether to skip the processed file
-                whether_to_skip = self.check_processed_file(f'CSV_{cell_name}')
+                # Check whether to skip the processed file, or a battery known
+                # to have no clean cycles
+                whether_to_skip = (
+                    battery_id in no_clean_ids or self.check_processed_file(f'CSV_{cell_name}'))
                 if whether_to_skip == True:
                     skip_batteries_num += 1
                     continue
@@ -57,77 +121,69 @@ class SDUPreprocessor(BasePreprocessor):
                 if not self.silent:
                     print(f'Processing battery {cell_name}')
                 
-                # Prepare data in the same format as CALCE
-                # Since we don't have dates, we'll use a dummy date
-                battery_df = battery_df.copy()
-                battery_df['date'] = '2023-01-01'  # Dummy date for consistency
-                
-                # Sort by Test_Time(s) - equivalent to CALCE's date+time sorting
-                battery_df = battery_df.sort_values(['Test_Time(s)'])
+                # Extract required columns
+                t = t_all[start:end]
+                I = I_all[start:end]  # noqa
+                V = V_all[start:end]
                 
                 # Organize cycle index using the same function as CALCE
-                battery_df['Cycle_Index'] = organize_cycle_index(battery_df['Cycle_Index'].values)
+                ci = organize_cycle_index(ci_all[start:end])
                 
-                # Extract required columns
-                columns_to_keep = [
-                    'date', 'Cycle_Index', 'Test_Time(s)', 'Current(A)', 'Voltage(V)'
-                ]
-                processed_df = battery_df[columns_to_keep]
-                
-                clean_cycles, cycles = [], []
-                for cycle_index, (_, cycle_df) in enumerate(processed_df.groupby(['date', 'Cycle_Index'])):
-                    I = cycle_df['Current(A)'].values  # noqa
-                    t = cycle_df['Test_Time(s)'].values
-                    V = cycle_df['Voltage(V)'].values
-                    
-                    # Calculate charge and discharge capacities using the same function as CALCE
-                    Qd = calc_Q(I, t, is_charge=False)
-                    Qc = calc_Q(I, t, is_charge=True)
-                    
-                    cycles.append(CycleData(
-                        cycle_number=cycle_index,
-                        voltage_in_V=V.tolist(),
-                        current_in_A=I.tolist(),
-                        time_in_s=t.tolist(),
-                        charge_capacity_in_Ah=Qc.tolist(),
-                        discharge_capacity_in_Ah=Qd.tolist()
-                    ))
+                # Rows are sorted by time, so every cycle is a contiguous run of ci
+                bounds = np.flatnonzero(np.diff(ci)) + 1
+                cycle_starts = np.append(0, bounds)
+                cycle_ends = np.append(bounds, len(ci))
+                
+                # Calculate charge and discharge capacities for all cycles in one pass
+                Qc_all, Qd_all = calc_Q_by_cycle(I, t, bounds)
                 
                 # Clean the cycles using the same logic as CALCE
-                Qd = []
-                for cycle_data in cycles:
-                    if len(cycle_data.discharge_capacity_in_Ah) > 0:
-                        Qd.append(max(cycle_data.discharge_capacity_in_Ah))
-                    else:
-                        Qd.append(0.0)
-                
-                if len(Qd) == 0:
+                # Discharge capacity never decreases within a cycle, so its maximum
+                # is the last value of the cycle
+                Qd = Qd_all[cycle_ends - 1].astype(np.float64)
+                
+                # Cycles with a non-finite capacity (e.g. from a NaN Test_Time(s))
+                # are dropped and left out of the median filter
+                valid_idx = np.flatnonzero(np.isfinite(Qd))
+                if len(valid_idx) == 0:
                     print(f"No valid cycles found for battery {cell_name}")
+                    no_clean_ids.add(battery_id)
                     continue
+                Qd_valid = Qd[valid_idx]
                 
                 # Apply median filtering for outlier detection
-                if len(Qd) >= 21:
-                    Qd_med = medfilt(Qd, 21)
-                else:
-                    Qd_med = medfilt(Qd, min(len(Qd), 5))  # Use smaller window for short sequences
-                
-                ths = np.median(abs(np.array(Qd) - Qd_med))
-                should_keep = abs(np.array(Qd) - Qd_med) < 3 * ths
-                
-                clean_cycles, index = [], 0
-                for i in range(len(cycles)):
-                    if should_keep[i] and Qd[i] > 0.1:
-                        index += 1
-                        cycles[i].cycle_number = index
-                        clean_cycles.append(cycles[i])
-                
-                if len(clean_cycles) == 0:
+                # Use smaller (odd) window for short sequences
+                window = 21 if len(Qd_valid) >= 21 else min(len(Qd_valid), 5)
+                window -= 1 - window % 2
+                Qd_med = rolling_median(Qd_valid, window)
+                
+                # Keep cycles within 3 MADs of the filtered curve (unscaled MAD,
+                # not 1.4826 * MAD, to match the CALCE threshold)
+                dev = np.abs(Qd_valid - Qd_med)
+                ths = np.median(dev)
+                keep_idx = valid_idx[(dev < 3 * ths) & (Qd_valid > 0.1)]
+                
+                if len(keep_idx) == 0:
                     print(f"No clean cycles found for battery {cell_name}")
+                    no_clean_ids.add(battery_id)
                     continue
                 
+                # Only build CycleData for the clean cycles, numbered from 1
+                clean_cycles = [None] * len(keep_idx)
+                for index, i in enumerate(keep_idx):
+                    cycle = slice(cycle_starts[i], cycle_ends[i])
+                    clean_cycles[index] = CycleData(
+                        cycle_number=index + 1,
+                        voltage_in_V=V[cycle],
+                        current_in_A=I[cycle],
+                        time_in_s=t[cycle],
+                        charge_capacity_in_Ah=Qc_all[cycle],
+                        discharge_capacity_in_Ah=Qd_all[cycle]
+                    )
+                
                 # Estimate nominal capacity from the first few cycles
-                initial_capacities = [max(cycle.discharge_capacity_in_Ah) for cycle in clean_cycles[:5]]
-                C = np.mean(initial_capacities) if initial_capacities else 1.0
+                initial_capacities = Qd[keep_idx[:5]]
+                C = np.mean(initial_capacities) if len(initial_capacities) else 1.0
                 
                 # Set default battery parameters (can be adjusted based on your battery specifications)
                 soc_interval = [0, 1]
@@ -144,40 +200,143 @@ class SDUPreprocessor(BasePreprocessor):
                     SOC_interval=soc_interval
                 )
                 
-                self.dump_single_file(battery)
+                dumps.append((battery.cell_id, io_pool.submit(self.dump_single_file, battery)))
                 process_batteries_num += 1
-                
-                if not self.silent:
-                    tqdm.write(f'File: {battery.cell_id} dumped to pkl file')
         
+        for cell_id, dump in dumps:
+            dump.result()  # Re-raise errors from the dump thread
+            if not self.silent:
+                tqdm.write(f'File: {cell_id} dumped to pkl file')
+        
+        self.dump_battery_index(csv_file, np.unique(ids).tolist(), sorted(no_clean_ids))
+    
         return process_batteries_num, skip_batteries_num
 
+    def dump_single_file(self, battery: BatteryData):
+        """
+        Dump the battery in the same layout as BatteryData.dump, using pickle
+        protocol 5 to serialize the cycle arrays efficiently
+        """
+        with open(Path(self.output_dir) / f'{battery.cell_id}.pkl', 'wb') as f:
+            pickle.dump(battery.to_dict(), f, protocol=5)
+
+    def check_processed_batteries(self, battery_ids, no_clean_ids=()):
+        """
+        Check whether all the given batteries have already been dumped or are
+        known to have no clean cycles
+        """
+        return all(
+            battery_id in no_clean_ids or self.check_processed_file(f'CSV_Battery_{battery_id}')
+            for battery_id in battery_ids)
+
+    def battery_index_path(self, csv_file):
+        return Path(self.output_dir) / f'{csv_file.stem}.idx.json'
+
+    def load_battery_index(self, csv_file):
+        """
+        Load the cached battery index of a CSV file, or None if the cache is
+        missing, unreadable or older than the CSV file
+        """
+        index_file = self.battery_index_path(csv_file)
+        if not index_file.exists():
+            return None
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(index, dict) or not {'mtime', 'ids', 'no_clean_ids'} <= index.keys():
+            return None
+        if index['mtime'] != csv_file.stat().st_mtime:
+            return None
+        return index
+
+    def dump_battery_index(self, csv_file, battery_ids, no_clean_ids):
+        """
+        Cache the battery ids of a CSV file, and the ids of batteries without
+        clean cycles, in the output directory
+        """
+        index = {
+            'mtime': csv_file.stat().st_mtime,
+            'ids': list(battery_ids),
+            'no_clean_ids': list(no_clean_ids),
+        }
+        with open(self.battery_index_path(csv_file), 'w') as f:
+            json.dump(index, f)
+
 
-@njit
-def calc_Q(I, t, is_charge):  # noqa
+def calc_Q_by_cycle(I, t, bounds):  # noqa
     """
-    Calculate charge/discharge capacity - same function as CALCE preprocessor
+    Calculate charge and discharge capacity of all cycles at once, using the
+    same per-cycle integration as the CALCE preprocessor's calc_Q. `bounds`
+    are the indices where new cycles start, as passed to np.split
     """
-    Q = np.zeros_like(I)
-    for i in range(1, len(I)):
-        if is_charge and I[i] > 0:
-            Q[i] = Q[i-1] + I[i] * (t[i] - t[i-1]) / 3600
-        elif not is_charge and I[i] < 0:
-            Q[i] = Q[i-1] - I[i] * (t[i] - t[i-1]) / 3600
-        else:
-            Q[i] = Q[i-1]
+    starts = np.concatenate(([0], bounds, [len(I)]))
+    return calc_Q_segments(I, t, starts, True), calc_Q_segments(I, t, starts, False)
+
+
+@njit(cache=True)
+def calc_Q_segments(I, t, starts, is_charge):  # noqa
+    """
+    Calculate charge/discharge capacity of every segment between consecutive
+    starts, restarting from zero in each segment. The capacity is
+    accumulated in float64 and stored as float32
+    """
+    Q = np.empty(len(I), dtype=np.float32)
+    for k in range(len(starts) - 1):
+        q = 0.
+        Q[starts[k]] = q
+        for i in range(starts[k] + 1, starts[k + 1]):
+            if is_charge and I[i] > 0:
+                q += I[i] * (t[i] - t[i-1]) / 3600
+            elif not is_charge and I[i] < 0:
+                q -= I[i] * (t[i] - t[i-1]) / 3600
+            Q[i] = q
     return Q
 
 
-@njit
+@njit(cache=True)
+def rolling_median(x, w):
+    """
+    Centered rolling median with an odd window size, reflecting at the edges.
+    Non-finite values would break the sorted window, so they are rejected
+    """
+    n, half = len(x), w // 2
+    for i in range(n):
+        if not np.isfinite(x[i]):
+            raise ValueError('rolling_median requires finite input')
+    padded = np.empty(n + 2 * half)
+    for i in range(n + 2 * half):
+        j = abs(i - half)
+        if j >= n:
+            j = 2 * (n - 1) - j
+        padded[i] = x[j]
+
+    window = np.sort(padded[:w])
+    out = np.empty(n)
+    out[0] = window[half]
+    for i in range(1, n):
+        # Replace the value leaving the window with the one entering it,
+        # keeping the window sorted by insertion
+        old, new = padded[i - 1], padded[i + w - 1]
+        k = 0
+        while k < w - 1 and window[k] != old:
+            k += 1
+        while k > 0 and window[k - 1] > new:
+            window[k] = window[k - 1]
+            k -= 1
+        while k < w - 1 and window[k + 1] < new:
+            window[k] = window[k + 1]
+            k += 1
+        window[k] = new
+        out[i] = window[half]
+    return out
+
+
 def organize_cycle_index(cycle_index):
     """
-    Organize cycle indices - same function as CALCE preprocessor
+    Organize cycle indices - same function as CALCE preprocessor, but
+    returning a new array instead of renumbering the input in place
     """
-    current_cycle, prev_value = cycle_index[0], cycle_index[0]
-    for i in range(1, len(cycle_index)):
-        if cycle_index[i] != prev_value:
-            current_cycle += 1
-            prev_value = cycle_index[i]
-        cycle_index[i] = current_cycle
-    return cycle_index 
\ No newline at end of file
+    changed = np.concatenate(([0], np.diff(cycle_index) != 0))
+    return np.cumsum(changed, dtype=cycle_index.dtype) + cycle_index[0]